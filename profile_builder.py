@@ -3,15 +3,59 @@ Blended Distillation Profile Builder
 '''
 
 import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+import lxml.html
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import requests
+from numba import njit, prange
+from pyarrow import csv as pacsv
+from requests.adapters import HTTPAdapter
 from scipy.interpolate import pchip
 
+# file store columns used for processing distillation profiles
+PROFILE_COLUMNS = ['Mass % Recovered', 'Temperature( oC )', 'Code']
+
+# concurrent requests (and pooled connections) used when fetching profiles from web
+FETCH_WORKERS = 16
+
+@njit(cache=True)
+def _mask_blended_temperatures(temperatures, percentages, recovery_max):
+    '''
+    Set temperatures to NaN at recovery points above the maximum possible
+    recovery rate for the blend, along with any outlier negative values
+    '''
+    for i in range(temperatures.size):
+        if percentages[i] > recovery_max or temperatures[i] < 0:
+            temperatures[i] = np.nan
+    return temperatures
+
+@njit(cache=True, parallel=True)
+def _mask_blended_temperatures_sweep(temperatures, percentages, recovery_max):
+    '''
+    Mask temperatures for each blend of a sweep (rows), given maximum possible
+    recovery rate for each blend
+    '''
+    for i in prange(temperatures.shape[0]):
+        _mask_blended_temperatures(temperatures[i], percentages, recovery_max[i])
+    return temperatures
+
 class BlendedProfileBuilder():
     '''
     Blended distillation builder class for processing blended oil profiles
     '''
 
+    # recovery levels (%) reported in blended distillation profiles
+    profile_percentages = np.array([5, 10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99],
+        dtype=np.int16)
+
+    # processed profiles and recovery fits keyed by oil code, shared across builders
+    _profile_index = None
+    _recovery_fits = {}
+
     def __init__(self, code1, code2, volume1, volume2, refresh=False):
         '''
         Args:
@@ -24,7 +68,6 @@ class BlendedProfileBuilder():
         if volume1 <= 0 or volume1 >= 1 or volume2 <= 0 or volume2 >= 1:
             raise ValueError
 
-        self.profile_percentages = [5, 10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99]
         self.code1 = code1
         self.code2 = code2
         self.volume1 = volume1
@@ -32,165 +75,321 @@ class BlendedProfileBuilder():
         self.refresh = refresh
 
     @staticmethod
-    def extract_profiles_from_web():
+    def fetch_profile_from_web(code, session=requests):
+        '''
+        Fetch distillation profile table for oil code from Crude Monitor website
+        Returns None if no distillation profile is found
+
+        Only the profile table is parsed from the webpage, with cell text kept as
+        strings (cleaned and typed when profiles are loaded from file store).
+        '''
+        try:
+            # distillation profile can be read from Crude Monitor website
+            url = f'https://www.crudemonitor.ca/crudes/dist.php?acr={code}&time=recent'
+            response = session.get(url, timeout=10)
+            response.raise_for_status()
+
+            # distillation profile is first table on webpage, with header as first row
+            table = lxml.html.fromstring(response.content).xpath('//table')[0]
+            rows = [[' '.join(cell.text_content().split()) for cell in row.xpath('./th|./td')]
+                for row in table.xpath('.//tr')]
+            oil_profile_df = pd.DataFrame(rows[1:], columns=rows[0])
+            oil_profile_df["Code"] = code
+            print(f"Successfully read profile for oil code {code}.")
+            return oil_profile_df
+        except Exception:
+            print(f"No distillation profile found for oil code {code}.")
+            return None
+
+    @classmethod
+    def extract_profiles_from_web(cls):
         '''
         Extract distillation profile tables from Crude Monitor website and load into file store
         '''
 
         oils = pd.read_csv("data/oil-codes.csv")
-        profiles_df = pd.DataFrame()
-
-        for code in oils['Code']:
-            try:
-                # distillation profile can be read from Crude Monitor website
-                url = f'https://www.crudemonitor.ca/crudes/dist.php?acr={code}&time=recent'
-                tables = pd.read_html(url)
-
-                # distillation profile is first table on webpage
-                oil_profile_df = tables[0]
-                oil_profile_df["Code"] = code
-                profiles_df = profiles_df.append(oil_profile_df)
-                print(f"Successfully read profile for oil code {code}.")
-            except:
-                print(f"No distillation profile found for oil code {code}.")
 
+        # profile requests are network bound, so fetch concurrently over pooled
+        # connections (results keep code order)
+        with requests.Session() as session:
+            session.mount('https://', HTTPAdapter(pool_maxsize=FETCH_WORKERS))
+            with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+                results = list(executor.map(partial(cls.fetch_profile_from_web,
+                    session=session), oils['Code']))
+
+        # accumulate fetched profiles and concatenate once into file store
+        frames = [df for df in results if df is not None]
+        if not frames:
+            print("No distillation profiles found, keeping existing file store.")
+            return
+
+        profiles_df = pd.concat(frames, ignore_index=True)
         profiles_df.to_csv("data/oil-profiles.csv")
 
-    @staticmethod
-    def load_processed_profile(code):
-        '''
-        Load distillation profile from file store and process
-        (isolate mass recovery and temperature features)
-        '''
-
-        profile_df = pd.read_csv("data/oil-profiles.csv")
-
-        # isolate relevant columns and rename
-        profile_df = profile_df[['Mass % Recovered', 'Temperature( oC )', 'Code']]
-        profile_df = profile_df[profile_df['Code'] == code].reset_index(drop=True)
-        profile_df.columns = ['recovery', 'temperature', 'code']
+        # keep columnar copy of relevant columns for fast loading, with profile
+        # values as strings (cleaned when loaded) and oil codes as categories
+        profiles_df = profiles_df[PROFILE_COLUMNS].astype('string').astype({'Code': 'category'})
+        profiles_df.to_parquet("data/oil-profiles.parquet", compression='snappy')
 
-        # set initial boiling point (IBP) to 0
-        profile_df['recovery'][profile_df['recovery'] == 'IBP'] = 0
+        # file store has been rewritten, drop any cached profiles, fits and pair recoveries
+        cls._profile_index = None
+        cls._recovery_fits = {}
+        cls._get_pair_recovery.cache_clear()
 
-        # remove blank recovery point temperature values
-        blank_temps = profile_df[profile_df['temperature'] == '-'].index
-        profile_df.drop(blank_temps, inplace=True)
-
-        # set data types after cleaning
-        profile_df = profile_df.astype({'recovery': 'int'})
-        profile_df = profile_df.astype({'temperature': 'float64'})
+    @classmethod
+    def _build_profile_index(cls):
+        '''
+        Load all distillation profiles from file store and process in a single pass
+        (isolate mass recovery and temperature features), indexed by oil code
+        '''
+        if cls._profile_index is not None:
+            return cls._profile_index
 
-        return profile_df
+        # prefer columnar file store, falling back to csv file store if not yet created
+        if os.path.exists("data/oil-profiles.parquet"):
+            profiles_df = pd.read_parquet("data/oil-profiles.parquet", columns=PROFILE_COLUMNS)
+        else:
+            # only parse relevant columns (multi-threaded arrow parser), read profile values
+            # as strings (cleaned and typed below) and oil codes as categories for fast grouping
+            convert_options = pacsv.ConvertOptions(include_columns=PROFILE_COLUMNS,
+                column_types={'Mass % Recovered': pa.string(), 'Temperature( oC )': pa.string(),
+                    'Code': pa.dictionary(pa.int32(), pa.string())})
+            profiles_table = pacsv.read_csv("data/oil-profiles.csv",
+                convert_options=convert_options)
+            profiles_df = profiles_table.to_pandas(types_mapper={pa.string(): pd.StringDtype()}.get)
+        profiles_df.columns = ['recovery', 'temperature', 'code']
+
+        # remove blank recovery point temperature values and set initial
+        # boiling point (IBP) to 0, then set data types after cleaning
+        profiles_df = (profiles_df[profiles_df['temperature'] != '-']
+            .assign(recovery=lambda df: df['recovery'].replace('IBP', '0'))
+            .astype({'recovery': 'int16', 'temperature': 'float32'}))
+
+        cls._profile_index = {}
+        for code, profile_df in profiles_df.groupby('code', sort=False, observed=True):
+            # keep temperature min/max with profile, used for building temperature ranges
+            temperatures = profile_df['temperature'].to_numpy()
+            profile_df.attrs['t_min'] = temperatures.min()
+            profile_df.attrs['t_max'] = temperatures.max()
+            cls._profile_index[code] = profile_df
+
+        return cls._profile_index
+
+    @classmethod
+    def get_valid_oil_codes(cls):
+        '''
+        Get oil codes with a distillation profile in file store
+        '''
+        return np.array(list(cls._build_profile_index()))
 
-    @staticmethod
-    def get_discrete_temperature_range(profile_df):
+    @classmethod
+    def load_processed_profile(cls, code):
         '''
-        Generate temperature points based on min/max range of profile
+        Load processed distillation profile for oil code
+
+        File store is read once and processed profiles are indexed by oil code,
+        callers receive a copy so the indexed profile is never mutated.
         '''
-        return np.arange(math.ceil(profile_df['temperature'].min()),
-            math.floor(profile_df['temperature'].max()), 1)
+        return cls._build_profile_index()[code].copy()
 
     @staticmethod
     def get_global_temperature_range(df1, df2):
         '''
         Generate global temperature points based on min/max range of profile pair
+        (using temperature min/max kept with each profile when loaded)
         '''
-        min_val = min(df1['temperature'].min(), df2['temperature'].min())
-        max_val = max(df1['temperature'].max(), df2['temperature'].max())
+        min_val = min(df1.attrs['t_min'], df2.attrs['t_min'])
+        max_val = max(df1.attrs['t_max'], df2.attrs['t_max'])
         return np.arange(math.ceil(min_val), math.floor(max_val), 1)
 
-    def get_recovery_interpolation(self, profile_df):
+    @classmethod
+    def get_recovery_fit(cls, code):
         '''
-        Get interpolation over profile range using monotonic cubic splines to find new points
+        Get monotonic cubic spline fit of profile for oil code
         https://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.PchipInterpolator.html
 
         Using same fit function used by Crude Monitor on distillation
         profile interpolation calculator.
 
-        Setting temperature as 'x' variable, will get interpolations
-        for 'Recovery %' over the range.
+        Setting temperature as 'x' variable, fit gives 'Recovery %'. Fit only depends
+        on the oil's profile, so it is cached per oil code.
+        '''
+        if code not in cls._recovery_fits:
+            profile_df = cls._build_profile_index()[code]
+            cls._recovery_fits[code] = pchip(profile_df['temperature'].to_numpy(),
+                profile_df['recovery'].to_numpy())
+        return cls._recovery_fits[code]
+
+    @classmethod
+    def get_recovery_interpolation(cls, code, temperature_range):
+        '''
+        Get interpolation of 'Recovery %' for oil code at each point of temperature range
+
+        The fit is only evaluated at discrete points within the profile's min/max range,
+        below it no mass recovery has occurred yet and above it no further mass
+        recovery occurs.
+        '''
+        interpolation_fit = cls.get_recovery_fit(code)
+
+        # first and last discrete temperature points within profile range
+        range_min = math.ceil(interpolation_fit.x[0])
+        range_max = math.floor(interpolation_fit.x[-1]) - 1
+
+        # temperature range is sorted, so only evaluate fit over the window within profile
+        # range, points below it have no recovery and points above hold the last recovery
+        window_start = np.searchsorted(temperature_range, range_min, side='left')
+        window_end = np.searchsorted(temperature_range, range_max, side='right')
+        recovery = np.zeros(len(temperature_range))
+        recovery[window_start:window_end] = interpolation_fit(
+            temperature_range[window_start:window_end])
+        recovery[window_end:] = interpolation_fit(range_max)
+        return recovery
+
+    def get_blended_temperatures(self, temperatures, blended, recovery_max):
+        '''
+        Get temperatures at each recovery level by reversed interpolation of blended
+        recovery rates over temperature points
         '''
-        x_values = np.array(profile_df['temperature'])
-        y_values = np.array(profile_df['recovery'])
 
-        temperature_range = self.get_discrete_temperature_range(profile_df)
+        # using blended recovery rate, perform an interpolation to now
+        # get temperatures at each recovery level
+        blended_temperatures = pchip(blended, temperatures)(self.profile_percentages)
 
-        interpolation_fit = pchip(x_values,y_values)
-        interpolation = pd.DataFrame({'temperature': temperature_range,
-            'recovery': interpolation_fit(temperature_range)})
-        interpolation = interpolation.set_index('temperature')
-        return interpolation
+        # set any recovery points above maximum possible overall recovery rate for
+        # blended mixture to NaN in final profile, along with any outlier negative values
+        return _mask_blended_temperatures(blended_temperatures,
+            self.profile_percentages, recovery_max)
 
-    @staticmethod
-    def merge_interpolations_over_range(interp1, interp2, temperature_range):
+    def compute_blended_temperatures_n(self, temperatures, recovery_matrix, shares,
+            recovery_max_per_oil):
         '''
-        Merge interpolations from input pair into the specified temperature range
+        Compute blended temperatures at each of the profile percentages for any number
+        of oils using volume shares and reversed interpolation
+
+        Recovery rates for each oil are columns of a matrix aligned to the temperature
+        points, with volume shares and maximum recovery rates given per oil (column).
         '''
-        merged_df = pd.DataFrame({'temperature': temperature_range})
-        merged_df = merged_df.set_index('temperature')
-        merged_df = merged_df.join(interp1).join(interp2, rsuffix='_2').reset_index()
-        merged_df = merged_df.fillna(method='ffill').fillna(value=0)
-        return merged_df
 
-    def compute_blended_profile(self, pair_df, share1, share2, df1, df2):
+        # at each temperature point, compute blended recovery rate, along with
+        # maximum possible overall recovery rate for blended mixture
+        blended = recovery_matrix @ shares
+        recovery_max = recovery_max_per_oil @ shares
+
+        return self.get_blended_temperatures(temperatures, blended, recovery_max)
+
+    def compute_blended_profile_n(self, temperatures, recovery_matrix, shares,
+            recovery_max_per_oil):
         '''
-        Compute blended distillation profile using volume share and reversed interpolation
+        Compute blended distillation profile for any number of oils using volume shares
+        and reversed interpolation (see compute_blended_temperatures_n)
         '''
+        return pd.DataFrame({'recovery': self.profile_percentages,
+            'temperature': self.compute_blended_temperatures_n(temperatures,
+                recovery_matrix, shares, recovery_max_per_oil)})
 
-        # at each temperature point, compute blended recovery rate
-        pair_df['blended'] = share1 * pair_df['recovery'] + share2 * pair_df['recovery_2']
+    def compute_blended_profile(self, temperatures, recovery_matrix, share1, share2,
+            recovery_max1, recovery_max2):
+        '''
+        Compute blended distillation profile for oil pair using volume share
+        and reversed interpolation
+        '''
+        return self.compute_blended_profile_n(temperatures, recovery_matrix,
+            np.array([share1, share2]), np.array([recovery_max1, recovery_max2]))
 
-        # using blended recovery rate, perform an interpolation to now
-        # get temperatures at each recovery level
-        blended_interp = pchip(pair_df['blended'], pair_df['temperature'])
-        temperatures = blended_interp(self.profile_percentages)
+    def get_pair_recovery(self):
+        '''
+        Get global temperature range for oil pair, with recovery interpolations over the
+        range for each oil (as matrix columns) and maximum recovery rate for each oil
+        '''
+        return self._get_pair_recovery(self.code1, self.code2)
 
-        blended_df = pd.DataFrame({'recovery': self.profile_percentages, 'temperature': temperatures})
+    @classmethod
+    @lru_cache(maxsize=64)
+    def _get_pair_recovery(cls, code1, code2):
+        '''
+        Pair recovery only depends on the oils' profiles, so it is cached per oil pair
+        (arrays are shared between builders, so are returned read-only)
+        '''
+
+        # distillation profiles are only read here, so use indexed profiles without copying
+        profile_index = cls._build_profile_index()
+        profile1_df = profile_index[code1]
+        profile2_df = profile_index[code2]
+
+        global_range = cls.get_global_temperature_range(profile1_df, profile2_df)
+        recovery_matrix = np.column_stack([
+            cls.get_recovery_interpolation(code1, global_range),
+            cls.get_recovery_interpolation(code2, global_range)])
+        recovery_max_per_oil = np.array([profile1_df['recovery'].max(),
+            profile2_df['recovery'].max()])
 
-        # compute maximum possible overall recovery rate for blended mixture and
-        # set any recovery points above this to NaN in final profile
-        recovery_max = df1['recovery'].max() * share1 + df2['recovery'].max() * share2
-        over_max = blended_df[blended_df['recovery'] > recovery_max]['temperature'].index
-        blended_df.loc[over_max, 'temperature'] = np.nan
+        for values in (global_range, recovery_matrix, recovery_max_per_oil):
+            values.setflags(write=False)
+        return global_range, recovery_matrix, recovery_max_per_oil
 
-        # set any outlier negative values to NaN
-        negative_val = blended_df[blended_df['temperature']
-                                  < 0]['temperature'].index
-        blended_df.loc[negative_val, 'temperature'] = np.nan
+    def run_array(self):
+        '''
+        Execute blended distillation profile builder, returning only the blended
+        temperatures at each of the profile percentages
+        Refresh distillation profiles if specified
+        '''
+        if self.refresh:
+            self.extract_profiles_from_web()
 
-        return blended_df
+        # using global temperature range for profile pair, create recovery interpolations
+        # over the range and then generate final blended distillation profile
+        global_range, recovery_matrix, recovery_max_per_oil = self.get_pair_recovery()
+        return self.compute_blended_temperatures_n(global_range, recovery_matrix,
+            np.array([self.volume1, self.volume2]), recovery_max_per_oil)
 
     def run(self):
         '''
         Execute blended distillation profile builder
         Refresh distillation profiles if specified
         '''
+        return pd.DataFrame({'recovery': self.profile_percentages,
+            'temperature': self.run_array()})
+
+    def run_share_sweep(self, shares1, shares2):
+        '''
+        Execute blended distillation profile builder over a sweep of volume shares
+        for the oil pair (in place of the builder's own volume shares)
+
+        Recovery interpolations are shared by every blend in the sweep, so blended
+        recovery rates for all shares are computed with a single matrix product.
+        Returns blended profiles for each blend stacked, with their volume shares.
+        '''
         if self.refresh:
             self.extract_profiles_from_web()
 
-        # load distillation profiles and create recovery interpolations
-        profile1_df = self.load_processed_profile(self.code1)
-        profile2_df = self.load_processed_profile(self.code2)
-        recovery1 = self.get_recovery_interpolation(profile1_df)
-        recovery2 = self.get_recovery_interpolation(profile2_df)
+        global_range, recovery_matrix, recovery_max_per_oil = self.get_pair_recovery()
+
+        # blended recovery rates (and maximum possible recovery rate) for each
+        # blend are the columns of the product with the share matrix
+        shares = np.vstack([shares1, shares2])
+        blended = recovery_matrix @ shares
+        recovery_max = recovery_max_per_oil @ shares
 
-        # using global temperature range for profile pair, merge interpolations and then
-        # generate final blended distillation profile
-        global_range = self.get_global_temperature_range(profile1_df, profile2_df)
-        paired_recovery = self.merge_interpolations_over_range(recovery1, recovery2, global_range)
-        blended_df = self.compute_blended_profile(paired_recovery,
-            self.volume1, self.volume2, profile1_df, profile2_df)
+        # get temperatures at each recovery level for each blend (rows), then mask
+        # unobtainable and negative temperatures for all blends at once
+        blended_temperatures = np.empty((shares.shape[1], len(self.profile_percentages)))
+        for i in range(shares.shape[1]):
+            blended_temperatures[i] = pchip(blended[:, i], global_range)(self.profile_percentages)
+        blended_temperatures = _mask_blended_temperatures_sweep(blended_temperatures,
+            self.profile_percentages, recovery_max)
 
-        return blended_df
+        n_percentages = len(self.profile_percentages)
+        return pd.DataFrame({'recovery': np.tile(self.profile_percentages, shares.shape[1]),
+            'temperature': blended_temperatures.ravel(),
+            'share1': np.repeat(shares1, n_percentages),
+            'share2': np.repeat(shares2, n_percentages)})
 
 if __name__ == "__main__":
 
     print("\nBlended Distillation Profile Builder...")
 
-    # load valid oil profiles from file store
-    valid_profiles_df = pd.read_csv("data/oil-profiles.csv")
-    valid_oil_codes = valid_profiles_df['Code'].unique()
+    # load valid oil profiles from file store (profiles are kept loaded for builder)
+    valid_oil_codes = BlendedProfileBuilder.get_valid_oil_codes()
 
     print("\nDistillation profile available for following oil codes:")
     print(valid_oil_codes)
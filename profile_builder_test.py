@@ -2,6 +2,7 @@
 Unit tests for BlendedProfileBuilder
 '''
 import unittest
+import numpy as np
 from profile_builder import BlendedProfileBuilder
 
 class TestBlendedProfileBuilder(unittest.TestCase):
@@ -9,9 +10,63 @@ class TestBlendedProfileBuilder(unittest.TestCase):
     def setUp(self):
         self.builder = BlendedProfileBuilder('AHS','AWB',0.5,0.5)
 
+    def test_get_valid_oil_codes(self):
+        self.assertIn('AHS', self.builder.get_valid_oil_codes())
+
     def test_load_processed_profile(self):
         self.assertEqual(3, len(self.builder.load_processed_profile('AHS').columns))
 
+    def test_load_processed_profile_cached_copy(self):
+        profile_df = self.builder.load_processed_profile('AHS')
+        profile_df['temperature'] = 0
+        reloaded_df = self.builder.load_processed_profile('AHS')
+        self.assertGreater(reloaded_df['temperature'].max(), 0)
+
+    def test_load_processed_profile_temperature_range(self):
+        profile_df = self.builder.load_processed_profile('AHS')
+        self.assertEqual(profile_df['temperature'].min(), profile_df.attrs['t_min'])
+        self.assertEqual(profile_df['temperature'].max(), profile_df.attrs['t_max'])
+
+    def test_get_recovery_interpolation(self):
+        temperature_range = np.arange(0, 1000)
+        recovery = self.builder.get_recovery_interpolation('AHS', temperature_range)
+        self.assertEqual(len(temperature_range), len(recovery))
+        self.assertEqual(0, recovery[0])
+        self.assertEqual(recovery[-2], recovery[-1])
+
+    def test_get_recovery_fit_cached(self):
+        self.assertIs(self.builder.get_recovery_fit('AHS'), self.builder.get_recovery_fit('AHS'))
+
+    def test_get_pair_recovery_cached(self):
+        other_builder = BlendedProfileBuilder('AHS', 'AWB', 0.25, 0.75)
+        self.assertIs(self.builder.get_pair_recovery(), other_builder.get_pair_recovery())
+
+    def test_compute_blended_profile(self):
+        temperatures = np.arange(0, 101, dtype='float64')
+        recovery_matrix = np.column_stack([temperatures * 0.9, temperatures * 0.9])
+        blended_df = self.builder.compute_blended_profile(temperatures,
+            recovery_matrix, 0.5, 0.5, 90, 90)
+        self.assertEqual(12, len(blended_df))
+        self.assertAlmostEqual(50 / 0.9, blended_df['temperature'][5])
+        self.assertTrue(blended_df['temperature'][-2:].isna().all())
+
+    def test_compute_blended_profile_n(self):
+        temperatures = np.arange(0, 101, dtype='float64')
+        recovery_matrix = np.column_stack([temperatures * 0.9] * 3)
+        blended_df = self.builder.compute_blended_profile_n(temperatures, recovery_matrix,
+            np.array([0.2, 0.3, 0.5]), np.array([90, 90, 90]))
+        pair_df = self.builder.compute_blended_profile(temperatures,
+            recovery_matrix[:, :2], 0.5, 0.5, 90, 90)
+        self.assertTrue(np.allclose(pair_df['temperature'], blended_df['temperature'],
+            equal_nan=True))
+
+    def test_run_share_sweep(self):
+        sweep_df = self.builder.run_share_sweep(np.array([0.25, 0.5]), np.array([0.75, 0.5]))
+        self.assertEqual(24, len(sweep_df))
+        blended_df = self.builder.run()
+        self.assertTrue(np.allclose(blended_df['temperature'],
+            sweep_df[sweep_df['share1'] == 0.5]['temperature'], equal_nan=True))
+
     # additional tests to be added below ...
 
 if __name__ == '__main__':
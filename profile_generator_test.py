@@ -3,31 +3,81 @@ Generation tests for BlendedProfileBuilder
 '''
 
 import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pacsv
+from tqdm import tqdm
 from profile_builder import BlendedProfileBuilder
 
+# number of blend percentages swept and written to file store at a time
+PERCENTAGE_BATCH_SIZE = 16
+
+def _preload_profiles(oil_codes):
+    '''
+    Load profiles and recovery fits for oil codes before starting worker processes,
+    so forked workers share them instead of each re-reading the file store
+    '''
+    for code in oil_codes:
+        BlendedProfileBuilder.get_recovery_fit(code)
+
+def _run_blend(code1, code2, share1, share2):
+    '''
+    Run builder for blend, returning blended temperatures at each profile percentage
+    (top-level so it can be dispatched to worker processes)
+    '''
+    return BlendedProfileBuilder(code1, code2, share1, share2).run_array()
+
 def generate_paired_blends(oil_codes):
     '''
     Generate blended pairs for all oil code pairings
     and store results to file store
     '''
 
-    blended_profiles_df = pd.DataFrame()
-
-    for pair in itertools.combinations(oil_codes,2):
-        code1, code2 = pair
-        volume1, volume2 = 0.5, 0.5
-
-        print(f"Running builder for oil pairing: {code1}, {code2}")
-        model = BlendedProfileBuilder(code1, code2, volume1, volume2)
-        blended_df = model.run()
-        blended_df["code1"] = code1
-        blended_df["code2"] = code2
-        blended_df["share1"] = volume1
-        blended_df["share2"] = volume2
-        blended_profiles_df = blended_profiles_df.append(blended_df)
+    if len(oil_codes) <= 1:
+        print("Not enough oil codes with valid data")
+        return
 
-    blended_profiles_df.to_csv("data/blended-profiles-all-pairings.csv")
+    pairs = np.array(list(itertools.combinations(oil_codes, 2)), dtype=object)
+    codes1, codes2 = pairs[:, 0], pairs[:, 1]
+    volumes = [0.5] * len(pairs)
+
+    # blended temperatures for each pairing (rows) are filled in as builders return
+    percentages = BlendedProfileBuilder.profile_percentages
+    temperatures = np.empty((len(pairs), len(percentages)))
+
+    # each pairing is independent, so run builders across worker processes, dispatching
+    # pairings in a few contiguous chunks per worker (processes rather than threads, as
+    # builder time is mostly python-level spline setup that holds the GIL)
+    _preload_profiles(oil_codes)
+    chunksize = max(1, len(pairs) // (4 * os.cpu_count()))
+    with ProcessPoolExecutor() as executor:
+        blended_temperatures = executor.map(_run_blend, codes1, codes2, volumes, volumes,
+            chunksize=chunksize)
+        for i, pair_temperatures in enumerate(tqdm(blended_temperatures, total=len(pairs),
+                desc="Running builder for oil pairings")):
+            temperatures[i] = pair_temperatures
+
+    # build all blended profiles at once, labelled with blend details
+    # (oil codes as categories and volume shares as float32 to keep labels compact),
+    # with code labels repeated as category codes per pairing rather than as strings per row
+    codes_dtype = pd.CategoricalDtype(categories=list(oil_codes))
+    shares = np.repeat(np.array(volumes, dtype=np.float32), len(percentages))
+    blended_profiles_df = pd.DataFrame({
+        'recovery': np.tile(percentages, len(pairs)),
+        'temperature': temperatures.ravel(),
+        'code1': pd.Categorical.from_codes(np.repeat(
+            codes_dtype.categories.get_indexer(codes1), len(percentages)), dtype=codes_dtype),
+        'code2': pd.Categorical.from_codes(np.repeat(
+            codes_dtype.categories.get_indexer(codes2), len(percentages)), dtype=codes_dtype),
+        'share1': shares,
+        'share2': shares})
+
+    # columnar output, with code labels stored dictionary encoded
+    blended_profiles_df.to_parquet("data/blended-profiles-all-pairings.parquet",
+        engine="pyarrow", compression="snappy", index=False)
 
 def generate_percentage_blends(oil_codes):
     '''
@@ -42,30 +92,48 @@ def generate_percentage_blends(oil_codes):
     code1 = oil_codes[0]
     code2 = oil_codes[1]
 
-    percentage_profiles_df = pd.DataFrame()
-
-    for volume1 in range(1,100):
-        share1 = volume1/100.0
-        share2 = (100 - volume1)/100.0
-
-        print(f"Running builder for percentage pairing: {share1:.2f}, {share2:.2f}")
-        model = BlendedProfileBuilder(code1, code2, share1, share2)
-        blended_df = model.run()
-        blended_df["code1"] = code1
-        blended_df["code2"] = code2
-        blended_df["share1"] = share1
-        blended_df["share2"] = share2
-        percentage_profiles_df = percentage_profiles_df.append(blended_df)
-
-    percentage_profiles_df.to_csv("data/blended-profiles-all-percentages.csv")
+    volumes1 = np.arange(1, 100)
+    shares1 = volumes1 / 100.0
+    shares2 = (100 - volumes1) / 100.0
+
+    # every blend percentage shares the pair's recovery interpolations, so run blends
+    # with builder sweeps over batches of shares, writing each batch as it completes
+    # to keep peak memory bounded (NaN temperatures are written as empty values)
+    print(f"Running builder for percentage pairings: {code1}, {code2}")
+    model = BlendedProfileBuilder(code1, code2, shares1[0], shares2[0])
+    codes_dtype = pd.CategoricalDtype(categories=[code1, code2])
+    writer = None
+    try:
+        for start in range(0, len(shares1), PERCENTAGE_BATCH_SIZE):
+            batch = slice(start, start + PERCENTAGE_BATCH_SIZE)
+            percentage_profiles_df = model.run_share_sweep(shares1[batch], shares2[batch])
+
+            # label with oil codes as categories and volume shares as float32
+            # to keep labels compact
+            n_rows = len(percentage_profiles_df)
+            percentage_profiles_df.insert(2, "code1",
+                pd.Categorical.from_codes(np.zeros(n_rows, dtype=np.int8), dtype=codes_dtype))
+            percentage_profiles_df.insert(3, "code2",
+                pd.Categorical.from_codes(np.ones(n_rows, dtype=np.int8), dtype=codes_dtype))
+            percentage_profiles_df = percentage_profiles_df.astype({'share1': 'float32',
+                'share2': 'float32'})
+
+            percentage_table = pa.Table.from_pandas(percentage_profiles_df,
+                preserve_index=False)
+            if writer is None:
+                writer = pacsv.CSVWriter("data/blended-profiles-all-percentages.csv",
+                    percentage_table.schema)
+            writer.write_table(percentage_table)
+    finally:
+        if writer is not None:
+            writer.close()
 
 if __name__ == "__main__":
 
     print("\nTest suite for BlendedProfileBuilder...")
 
-    # Retrieve valid oil codes with stored profile data
-    profiles_df = pd.read_csv(("data/oil-profiles.csv"))
-    valid_oil_codes = profiles_df['Code'].unique()
+    # Retrieve valid oil codes with stored profile data (profiles are kept loaded for builders)
+    valid_oil_codes = BlendedProfileBuilder.get_valid_oil_codes()
 
     print("\nGenerating 50-50% profiles for all oil code pairings...")
     generate_paired_blends(valid_oil_codes)